@@ -4,6 +4,30 @@ import typing
 class Answer(object):
     """An Answer (in a QAExample) with all relevant metadata."""
 
+    __slots__ = (
+        "text",
+        "spans",
+        "ner_label",
+        "kb_id",
+        "wikidata_label",
+        "aliases",
+        "wikidata_types",
+        "wikipedia_page",
+        "popularity",
+        "answer_type",
+    )
+
+    # The answer type assigned to each NER label by `_select_answer_type`.
+    NER_LABEL_TO_ANSWER_TYPE = {
+        "PERSON": "PERSON",
+        "DATE": "DATE",
+        "CARDINAL": "NUMERIC",
+        "QUANTITY": "NUMERIC",
+        "GPE": "LOCATION",
+        "LOC": "LOCATION",
+        "ORG": "ORGANIZATION",
+    }
+
     def __init__(
         self,
         text: str,
@@ -28,7 +52,8 @@ class Answer(object):
                 the NER/Entity Linker model. Will often be `None` if not found.
             wikidata_label: The official Wikidata name corresponding to the found Wikidata ID.
             aliases: The official Wikidata aliases for the text associated with this Wikidata ID.
-            wikidata_types: List of Wikidata entity types associated with this Wikidata ID.
+                Kept as an ordered list (not a set), as alias substitution picks aliases in order.
+            wikidata_types: Set of Wikidata entity types associated with this Wikidata ID.
             wikipedia_page: The Wikipedia page associated with this Wikidata ID.
             popularity: The popularity, measured in daily page views, associated with this 
                 Wikidata ID.
@@ -44,7 +69,9 @@ class Answer(object):
         # Fields supplied by Wikidata Entity Info (from Stage 2) if self.kb_id identified.
         self.wikidata_label = wikidata_label
         self.aliases = aliases
-        self.wikidata_types = wikidata_types
+        self.wikidata_types = (
+            frozenset(wikidata_types) if wikidata_types is not None else None
+        )
         self.wikipedia_page = wikipedia_page
         self.popularity = popularity
 
@@ -67,7 +94,7 @@ class Answer(object):
         """Updates the Answer fields with Wikidata entity info, if there is a Wikidata ID."""
         self.wikidata_label = label
         self.aliases = aliases
-        self.wikidata_types = [etype.lower() for etype in entity_types]
+        self.wikidata_types = frozenset(etype.lower() for etype in entity_types)
         self.wikipedia_page = wikipedia_page
         self.popularity = popularity
 
@@ -91,26 +118,31 @@ class Answer(object):
         """Assigns this Answer a category/type. This type is used by substitution functions to 
         ensure the resulting substitution is coherent, or type-preserving.
 
-        NB: This function can be edited by the user if they have their own NER model, or another
-            set of answer types / substitutions they wish to analyze.
+        NB: This function (and `NER_LABEL_TO_ANSWER_TYPE`) can be edited by the user if they
+            have their own NER model, or another set of answer types / substitutions they wish
+            to analyze.
         """
-        answer_type = None
-        if self.ner_label == "PERSON":
-            answer_type = "PERSON"
-        elif self.ner_label == "DATE" or (
-            self.ner_label == "CARDINAL" and "year" in self.wikidata_types
-        ):
+        answer_type = self.NER_LABEL_TO_ANSWER_TYPE.get(self.ner_label)
+        if self.ner_label == "CARDINAL" and "year" in self.wikidata_types:
             answer_type = "DATE"
-        elif self.ner_label in ["CARDINAL", "QUANTITY"]:
-            answer_type = "NUMERIC"
-        elif self.ner_label in ["GPE", "LOC"]:
-            answer_type = "LOCATION"
-        elif self.ner_label == "ORG":
-            answer_type = "ORGANIZATION"
         return answer_type
 
     def json_dump(self):
-        return self.__dict__
+        """Creates a json dump of this Answer. Can be loaded using `json_load`."""
+        return {
+            "text": self.text,
+            "spans": self.spans,
+            "ner_label": self.ner_label,
+            "kb_id": self.kb_id,
+            "wikidata_label": self.wikidata_label,
+            "aliases": self.aliases,
+            "wikidata_types": (
+                sorted(self.wikidata_types) if self.wikidata_types is not None else None
+            ),
+            "wikipedia_page": self.wikipedia_page,
+            "popularity": self.popularity,
+            "answer_type": self.answer_type,
+        }
 
     @classmethod
     def json_load(cls, obj: typing.Dict[str, typing.Any]):
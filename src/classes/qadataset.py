@@ -1,16 +1,22 @@
-import gzip
-import json
 import os
 import typing
 from collections import defaultdict
 
-import wget
-
 from src.classes.qaexample import QAExample
-from src.utils import BasicTimer, run_ner_linking
+from src.utils import (
+    BasicTimer,
+    gzip,
+    iter_wikidata_info,
+    json_dumps_line,
+    json_loads,
+    normalize_text,
+    run_ner_linking,
+)
 
 ORIG_DATA_DIR = "datasets/original/"
 NORM_DATA_DIR = "datasets/normalized/"
+# Serialized examples are buffered and handed to the gzip writer in chunks of this size.
+WRITE_BUFFER_SIZE = 64 * 1024 * 1024
 
 
 class QADataset(object):
@@ -34,11 +40,18 @@ class QADataset(object):
             preprocessed_path: The path to the data after processing and saving.
             examples: A list of QAExamples in this dataset. This field is populated by
                 `self.read_original_dataset` and later augmented by `self.preprocess`.
+            answer_types: The answer type of each example, parallel to `examples`.
+            norm_gold_texts: The frozenset of normalized gold answer texts of each example,
+                parallel to `examples`.
         """
         self.name = name
         self.original_path = original_path
         self.preprocessed_path = preprocessed_path
         self.examples = examples
+        self.answer_types = None
+        self.norm_gold_texts = None
+        if examples is not None:
+            self._precompute_indexes()
 
     @classmethod
     def new(cls, name: str, url_or_path: str):
@@ -70,13 +83,22 @@ class QADataset(object):
             preprocessed_path
         ), f"Preprocessed dataset should be at {preprocessed_path}."
         with gzip.open(preprocessed_path, "r") as inf:
-            header = json.loads(inf.readline())
+            header = json_loads(inf.readline())
             assert header["dataset"] == name
-            examples = [QAExample.json_load(l) for l in inf.readlines()]
+            examples = [QAExample.json_load(json_loads(l)) for l in inf]
 
         print(f"Read {len(examples)} examples from {preprocessed_path}")
         return cls(name, header["original_path"], preprocessed_path, examples)
 
+    def _precompute_indexes(self):
+        """Caches per-example values that the substitution functions need for every
+        example, so they are computed once per dataset rather than once per use."""
+        self.answer_types = [ex.get_example_answer_type() for ex in self.examples]
+        self.norm_gold_texts = [
+            frozenset(normalize_text(ga.text) for ga in ex.gold_answers)
+            for ex in self.examples
+        ]
+
     @classmethod
     def _get_norm_dataset_path(self, name: str):
         """Formats the path to the normalized/preprocessed data."""
@@ -86,6 +108,9 @@ class QADataset(object):
     def _download(cls, name: str, url: str, dest_path: str):
         """Downloads the original dataset from `url` to `dest_path`."""
         if not os.path.exists(dest_path):
+            # Only needed (and imported) when a dataset isn't available locally.
+            import wget
+
             os.makedirs(os.path.dirname(dest_path), exist_ok=True)
             print(f"Downloading Original Dataset: {name}")
             wget.download(url, dest_path)
@@ -93,12 +118,16 @@ class QADataset(object):
     def save(self):
         """Save the preprocessed dataset to JSONL.GZ file. Can be loaded using `self.load()`."""
         os.makedirs(os.path.dirname(self.preprocessed_path), exist_ok=True)
-        with gzip.open(self.preprocessed_path, "wt") as outf:
-            json.dump({"dataset": self.name, "original_path": self.original_path}, outf)
-            outf.write("\n")
+        buffer = bytearray(
+            json_dumps_line({"dataset": self.name, "original_path": self.original_path})
+        )
+        with gzip.open(self.preprocessed_path, "wb") as outf:
             for ex in self.examples:
-                json.dump(ex.json_dump(), outf)
-                outf.write("\n")
+                buffer += json_dumps_line(ex.json_dump())
+                if len(buffer) >= WRITE_BUFFER_SIZE:
+                    outf.write(buffer)
+                    buffer.clear()
+            outf.write(buffer)
         print(f"Saved preprocessed dataset to {self.preprocessed_path}")
 
     def read_original_dataset(self, file_path: str):
@@ -110,7 +139,13 @@ class QADataset(object):
         pass
 
     def preprocess(
-        self, wikidata_info_path: str, ner_model_path: str, debug: bool = False
+        self,
+        wikidata_info_path: str,
+        ner_model_path: str,
+        debug: bool = False,
+        batch_size: int = 128,
+        n_process: int = 1,
+        use_gpu: bool = False,
     ):
         """Read the original dataset, normalize its format and preprocess it. This includes
         running the NER model on the answers, and linking those to wikidata for additional
@@ -120,6 +155,9 @@ class QADataset(object):
             wikidata_info_path: Path to the wikidata entity info saved from Step 1.
             ner_model_path: Path to our SpaCy NER model, downloaded during setup.
             debug: If true, only sample 500 examples to quickly check everything runs end-t-end.
+            batch_size: How many answers the NER model processes at a time.
+            n_process: How many processes to run the NER model in (-1 for one per CPU).
+            use_gpu: Whether to run the NER model on the GPU (in a single process).
         """
         timer = BasicTimer(f"{self.name} Preprocessing")
         examples = self.read_original_dataset(self.original_path)
@@ -127,36 +165,74 @@ class QADataset(object):
             examples = examples[:500]
         print(f"Processing {len(examples)} Examples...")
 
-        self.label_entities(examples, ner_model_path)
+        self.label_entities(
+            examples,
+            ner_model_path,
+            batch_size=batch_size,
+            n_process=n_process,
+            use_gpu=use_gpu,
+        )
         timer.interval("Labelling and Linking Named Entities")
         self.wikidata_linking(examples, wikidata_info_path)
         timer.interval("Wikidata and Popularity Linking")
         self.examples = examples
+        self._precompute_indexes()
 
         self._report_dataset_stats()
         self.save()
         timer.finish()
 
-    def label_entities(self, examples: typing.List[QAExample], ner_model_path: str):
+    def label_entities(
+        self,
+        examples: typing.List[QAExample],
+        ner_model_path: str,
+        batch_size: int = 128,
+        n_process: int = 1,
+        use_gpu: bool = False,
+    ):
         """Populate each answer with the NER labels and wikidata ID, if found."""
-        all_answers = [answer.text for ex in examples for answer in ex.gold_answers]
-        answers_to_info = run_ner_linking(all_answers, ner_model_path)
+        # Answers repeat heavily across examples, so only run NER once per unique text.
+        all_answers = list(
+            dict.fromkeys(answer.text for ex in examples for answer in ex.gold_answers)
+        )
+        answers_ner_info = run_ner_linking(
+            all_answers,
+            ner_model_path,
+            batch_size=batch_size,
+            n_process=n_process,
+            use_gpu=use_gpu,
+        )
 
+        # Only keep the match found within each answer that is equivalent to the whole
+        # answer (the last such match wins), indexed by the answer text.
+        answers_to_equivalent_info = {}
+        for text, infos in answers_ner_info:
+            text_lower = text.lower()
+            for ner_info in infos:
+                if ner_info["text"].lower() == text_lower:
+                    answers_to_equivalent_info[text] = ner_info
         for ex in examples:
             for answer in ex.gold_answers:
-                # for each match found within the answer
-                for ner_info in answers_to_info[answer.text]:
-                    if answer.is_equivalent(ner_info["text"]):
-                        answer.update_ner_info(
-                            ner_info["label"], ner_info["id"]
-                        )  # update answer
+                ner_info = answers_to_equivalent_info.get(answer.text)
+                if ner_info:
+                    answer.update_ner_info(ner_info["label"], ner_info["id"])
 
     def wikidata_linking(
         self, examples: typing.List[QAExample], wikidata_info_path: str
     ):
         """Using the answer's wikidata IDs (if found), extracts wikidata metadata."""
-        with gzip.open(wikidata_info_path, "r") as inf:
-            wikidata_info = json.load(inf)
+        # Only keep the (few) entities that are linked to an answer.
+        linked_ids = {
+            answer.kb_id
+            for ex in examples
+            for answer in ex.gold_answers
+            if answer.kb_id
+        }
+        wikidata_info = {
+            kb_id: info
+            for kb_id, info in iter_wikidata_info(wikidata_info_path)
+            if kb_id in linked_ids
+        }
 
         for ex in examples:
             for answer in ex.gold_answers:
@@ -166,8 +242,8 @@ class QADataset(object):
     def _report_dataset_stats(self):
         """Reports basic statistics on what is contained in a preprocessed dataset."""
         grouped_examples = defaultdict(list)
-        for ex in self.examples:
-            grouped_examples[ex.get_example_answer_type()].append(ex)
+        for ex, answer_type in zip(self.examples, self.answer_types):
+            grouped_examples[answer_type].append(ex)
 
         print("Dataset Statistics")
         print("-------------------------------------------")
@@ -194,9 +270,9 @@ class MRQANaturalQuetsionsDataset(QADataset):
         """
         examples = []
         with gzip.open(file_path, "rb") as file_handle:
-            header = json.loads(file_handle.readline())["header"]
+            header = json_loads(file_handle.readline())["header"]
             for entry in file_handle:
-                entry = json.loads(entry)
+                entry = json_loads(entry)
                 for qa in entry["qas"]:
                     examples.append(
                         QAExample.new(
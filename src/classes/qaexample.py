@@ -1,3 +1,4 @@
+import functools
 import json
 import re
 import typing
@@ -5,10 +6,82 @@ from collections import Counter
 
 from src.classes.answer import Answer
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+@functools.lru_cache(maxsize=8192)
+def _build_answer_finder(answer_texts_lower: typing.Tuple[str, ...]):
+    """Builds a function that finds all non-overlapping instances of any of the (non-empty,
+    lowercased) `answer_texts_lower` in a lowercased context, in a single pass. Where
+    answers overlap, the leftmost and then longest one is matched.
+
+    A single answer is found with `str.find`. Otherwise uses an Aho-Corasick automaton if
+    `pyahocorasick` is installed, or else a regex alternation of the answers. Finders are
+    cached, as every substitute derived from an example (and any example sharing its
+    answers) searches for the same answer texts.
+    """
+    if len(answer_texts_lower) == 1:
+        (text,) = answer_texts_lower
+
+        def find_literal(context_lower):
+            spans, start = [], context_lower.find(text)
+            while start != -1:
+                spans.append((start, start + len(text)))
+                start = context_lower.find(text, start + len(text))
+            return spans
+
+        return find_literal
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for text in answer_texts_lower:
+            automaton.add_word(text, len(text))
+        automaton.make_automaton()
+
+        def find_with_automaton(context_lower):
+            # The automaton reports every (possibly overlapping) match, so keep the
+            # leftmost-longest non-overlapping ones, as the regex alternation does.
+            matches = sorted(
+                (end - length + 1, -length)
+                for end, length in automaton.iter(context_lower)
+            )
+            spans, last_end = [], 0
+            for start, neg_length in matches:
+                if start >= last_end:
+                    last_end = start - neg_length
+                    spans.append((start, last_end))
+            return spans
+
+        return find_with_automaton
+
+    pattern = re.compile(
+        "|".join(
+            re.escape(text)
+            for text in sorted(answer_texts_lower, key=len, reverse=True)
+        )
+    )
+    return lambda context_lower: [
+        (m.start(), m.end()) for m in pattern.finditer(context_lower)
+    ]
+
 
 class QAExample(object):
     """A Question Answering Example."""
 
+    __slots__ = (
+        "uid",
+        "query",
+        "_context",
+        "_context_lower",
+        "gold_answers",
+        "metadata",
+        "is_substitute",
+        "original_example",
+    )
+
     def __init__(
         self,
         uid: str,
@@ -40,6 +113,22 @@ class QAExample(object):
         self.is_substitute = is_substitute
         self.original_example = original_example
 
+    @property
+    def context(self):
+        return self._context
+
+    @context.setter
+    def context(self, context: str):
+        self._context = context
+        self._context_lower = None
+
+    @property
+    def context_lower(self):
+        """The lowercased context passage, computed once per (re)assignment of `context`."""
+        if self._context_lower is None:
+            self._context_lower = self._context.lower()
+        return self._context_lower
+
     @classmethod
     def new(
         cls,
@@ -56,8 +145,9 @@ class QAExample(object):
         as `Answer` objects.
         """
         gold_answers = []
+        context_lower = context.lower()
         for text in answers:
-            context_spans = cls._find_answer_in_context(text, context)
+            context_spans = cls._find_answer_in_context(text, context, context_lower)
             gold_answers.append(Answer(text, spans=context_spans))
         return cls(
             uid=uid,
@@ -71,8 +161,11 @@ class QAExample(object):
 
     @classmethod
     def json_load(cls, json_obj):
-        """Loads a json dump of a QAExample. Call this after `self.json_dump`."""
-        obj = json.loads(json_obj)
+        """Loads a json dump of a QAExample. Call this after `self.json_dump`.
+
+        `json_obj` may be the already-decoded dict, or its raw JSON string.
+        """
+        obj = json_obj if isinstance(json_obj, dict) else json.loads(json_obj)
         return cls(
             uid=obj["uid"],
             query=obj["query"],
@@ -84,17 +177,39 @@ class QAExample(object):
         )
 
     @classmethod
-    def _find_answer_in_context(cls, answer_text: str, context: str):
+    def _find_answer_in_context(
+        cls, answer_text: str, context: str, context_lower: str = None
+    ):
         """Finds all instances of the `answer_text` in the context passage.
-        
+
+        `context_lower` may be passed to reuse an already lowercased context.
+
         Returns a list of (start index, end index) tuples.
         """
+        if context_lower is None:
+            context_lower = context.lower()
         context_spans = [
             (m.start(), m.end())
-            for m in re.finditer(re.escape(answer_text.lower()), context.lower())
+            for m in re.finditer(re.escape(answer_text.lower()), context_lower)
         ]
         return context_spans
 
+    @classmethod
+    def _find_answers_in_context(
+        cls, answer_texts: typing.List[str], context_lower: str
+    ):
+        """Finds all instances of any of the `answer_texts` in the lowercased context
+        passage, in a single pass. Where answers overlap, the longest one is matched.
+
+        Returns a list of (start index, end index) tuples.
+        """
+        answer_texts_lower = tuple(
+            sorted({text.lower() for text in answer_texts if text})
+        )
+        if not answer_texts_lower:
+            return []
+        return _build_answer_finder(answer_texts_lower)(context_lower)
+
     def json_dump(self, save_full: bool = False):
         """Creates a json dump of this QAExample.
         
@@ -116,6 +231,36 @@ class QAExample(object):
                 save_obj["original_example"] = self.original_example.uid
         return save_obj
 
+    def substitute(
+        self,
+        sub_answer: Answer,
+        sub_type: str,
+        replace_every_original_answer: bool = False,
+    ):
+        """Returns a new substitute example, in which `sub_answer` replaces this example's
+        answers in the context. The new example shares this example's query, and only
+        allocates its own uid, context and gold answers. This example is left unchanged.
+
+        Args:
+            sub_answer: The new Answer object that is replacing the existing gold_answers
+            sub_type: a prefix that represents this type of substitution, saved as part of the new
+                uid.
+            replace_every_original_answer: If False, only replace the main gold answer that appears
+                in the text, otherwise replace all valid gold answers that appear in the text.
+        """
+        sub_context, sub_answer.spans = self._substitute_context(
+            sub_answer, replace_every_original_answer=replace_every_original_answer
+        )
+        return type(self)(
+            uid=f"{sub_type}_{self.uid}",
+            query=self.query,
+            context=sub_context,
+            gold_answers=[sub_answer],
+            is_substitute=True,
+            metadata=dict(self.metadata) if self.metadata is not None else None,
+            original_example=self,
+        )
+
     def apply_substitution(
         self,
         sub_answer: Answer,
@@ -124,7 +269,7 @@ class QAExample(object):
         replace_every_original_answer: bool = False,
     ):
         """Applies the substitution to this example, modifying it's own uid, context 
-        and gold answers.
+        and gold answers. See `substitute` to derive a new example instead.
 
         Args:
             sub_answer: The new Answer object that is replacing the existing gold_answers
@@ -136,12 +281,10 @@ class QAExample(object):
         """
         # update uid
         self.uid = f"{sub_type}_{self.uid}"
-        # update context
-        self.update_context_with_substitution(
+        # update context, and new answer with the spans it was inserted at
+        sub_answer.spans = self.update_context_with_substitution(
             sub_answer, replace_every_original_answer=replace_every_original_answer
         )
-        # update new answer with spans
-        spans = self._find_answer_in_context(sub_answer.text, self.context)
         self.gold_answers = [sub_answer]
         self.is_substitute = True
         self.original_example = original_example
@@ -149,21 +292,45 @@ class QAExample(object):
     def update_context_with_substitution(
         self, sub_answer: Answer, replace_every_original_answer=False
     ):
-        """Replace all found instances of the answer in the context."""
-        replace_spans = []
+        """Replace all found instances of the answer in the context.
+
+        Returns a list of (start index, end index) tuples, where the substitute answer was
+        inserted into the new context.
+        """
+        self.context, sub_spans = self._substitute_context(
+            sub_answer, replace_every_original_answer=replace_every_original_answer
+        )
+        return sub_spans
+
+    def _substitute_context(
+        self, sub_answer: Answer, replace_every_original_answer=False
+    ):
+        """Computes the context with all found instances of the answer replaced, without
+        modifying this example.
+
+        Returns the new context, and a list of (start index, end index) tuples where the
+        substitute answer was inserted into it.
+        """
         replace_answers = (
             self.gold_answers
             if replace_every_original_answer
             else [a for a in self.gold_answers if a.is_answer_in_context()][0]
         )
-        for orig_answer in self.gold_answers:
-            replace_spans.extend(
-                self._find_answer_in_context(orig_answer.text, self.context)
-            )
-        # Find and replace all string variants that correspond to the original answer in the context
-        replace_strs = set([self.context[span[0] : span[1]] for span in replace_spans])
-        for replace_str in replace_strs:
-            self.context = self.context.replace(replace_str, sub_answer.text)
+        replace_spans = self._find_answers_in_context(
+            [orig_answer.text for orig_answer in self.gold_answers],
+            self.context_lower,
+        )
+        # Rebuild the context in one pass, swapping each (sorted, non-overlapping) span
+        # of an original answer for the substitute answer.
+        context_parts, sub_spans, last_end, shift = [], [], 0, 0
+        for start, end in replace_spans:
+            context_parts.append(self.context[last_end:start])
+            context_parts.append(sub_answer.text)
+            sub_spans.append((start + shift, start + shift + len(sub_answer.text)))
+            shift += len(sub_answer.text) - (end - start)
+            last_end = end
+        context_parts.append(self.context[last_end:])
+        return "".join(context_parts), sub_spans
 
     def get_answers_in_context(self):
         """Find all gold answers that appear in the context passage, excluding those that don't."""
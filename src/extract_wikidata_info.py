@@ -1,24 +1,24 @@
 """Extracts Wikidata entity information from various dumps and outputs to a
-single JSON file. The JSON file is broken down into a line for each entity
-for easy reading. Each line has the following format:
+single JSON lines file, with one JSON object per entity so that it can be
+streamed. Each line has the following format:
 
-entity_id: {
+{entity_id: {
     "label": ``str`` Name of entity,
     "aliases": ``str`` Alternative names of entities,
     "entity_types: ``list[str]`` List of entity types,
     "wikipedia_page": ``str`` Wikipedia page of entity,
     "popularity": ``int`` Number of page views for Wikipedia page for one day
-}
+}}
 """
 import argparse
 import bz2
 import collections
-import gzip
+import multiprocessing
 import os
 
 import tqdm
 
-from src.utils import BasicTimer
+from src.utils import BasicTimer, gzip, indexed_bzip2, json_loads
 
 try:
     import ujson as json
@@ -26,6 +26,15 @@ except ImportError:
     import json
 
 
+def open_bz2(path, parallelization=None):
+    """Opens a .bz2 file for reading bytes. Uses the multi-threaded block-parallel
+    decompressor from `indexed_bzip2` if installed, with `parallelization` threads (one
+    per CPU by default), otherwise the stdlib `bz2` module."""
+    if indexed_bzip2 is not None:
+        return indexed_bzip2.open(
+            path, parallelization=parallelization or os.cpu_count()
+        )
+    return bz2.open(path, "rb")
 
 
 def extract_label(line):
@@ -68,32 +77,85 @@ def extract_popularities(popularity_dump):
         page views for a day.
 
     Returns:
-        wiki_popularity: ``dict`` Maps from a Wikipedia page to the daily
-        page view count.
+        wiki_popularity: ``dict`` Maps from a Wikipedia page (as UTF-8 ``bytes``)
+        to the daily page view count.
     """
     wiki_popularity = collections.defaultdict(int)
-    with bz2.open(popularity_dump, "rt") as bz_file:
-        # Each line corresponds to the number of page views for a Wikipedia page
+    with open_bz2(popularity_dump) as bz_file:
+        # Each line corresponds to the number of page views for a Wikipedia page.
+        # Lines and page names are kept as bytes, so nothing is ever decoded.
         for line in tqdm.tqdm(bz_file, desc="Loading Wikipedia popularity values"):
-            line = line.strip().split()
-            # Skip lines w/o right len or Wikipedia pages that aren't in English
-            if len(line) == 6 and line[0] == "en.wikipedia":
+            # Skip Wikipedia pages that aren't in English before paying for a split
+            if not line.startswith(b"en.wikipedia "):
+                continue
+            line = line.split()
+            # Skip lines w/o right len
+            if len(line) == 6:
                 wiki_popularity[line[1]] += int(line[4])
     print(f"Found {len(wiki_popularity)} English Wikipedia pages")
     return wiki_popularity
 
 
-def extract_entity_information(popularity_dump, wikidata_dump, output_file):
+# Set in each worker process by `_init_entity_worker`, so the (large) popularity
+# mapping is shared once per worker rather than shipped with every line.
+_WIKI_POPULARITY = None
+
+
+def _init_entity_worker(wiki_popularity):
+    global _WIKI_POPULARITY
+    _WIKI_POPULARITY = wiki_popularity
+
+
+def process_entity_line(line):
+    """Extracts the relevant information for the entity on one line of the
+    Wikidata dump.
+
+    Args:
+        line: ``bytes`` A line of the Wikidata dump, stripped of its trailing comma.
+
+    Returns:
+        entity_bytes: ``bytes`` The `{"entity_id": {...}}` JSON line for this entity,
+        or None if the entity has no entity type, label, or popularity value.
+    """
+    line = json_loads(line)
+
+    # For each line, extract out relevant Wikidata information
+    label = extract_label(line)
+    aliases = extract_aliases(line)
+    entity_types = extract_entity_types(line)
+    wikipedia_page = extract_wikipedia_page(line)
+    popularity = (
+        _WIKI_POPULARITY.get(wikipedia_page.encode()) if wikipedia_page else None
+    )
+
+    # Skip if no entity type, label, or popularity value
+    if label is None or popularity is None or entity_types == []:
+        return None
+
+    entity_dict = {
+        "label": label,
+        "aliases": aliases,
+        "entity_types": entity_types,
+        "wikipedia_page": wikipedia_page,
+        "popularity": popularity,
+    }
+    return json.dumps({line["id"]: entity_dict}, ensure_ascii=False).encode() + b"\n"
+
+
+def extract_entity_information(
+    popularity_dump, wikidata_dump, output_file, num_workers=1
+):
     """For each Wikidata entity in the Wikidata dump, we extract out it's entity
     type, associated Wikipedia page (used for popularity), all aliases
     for the entity, and popularity of the entity's Wikipedia page, then write
-    this information into a JSON file. We write each dictionary of entity
-    information in it's own line for easy readability.
+    this information into a JSON lines file. We write each dictionary of entity
+    information in it's own line, so the file can be streamed.
 
     Args:
         popularity_dump: ``str``: Path to the Wikipedia popularity dump
         wikidata_dump: ``str`` Path to the Wikidata dump
         output_file: ``str`` Output JSON file
+        num_workers: ``int`` Number of processes used to decode and extract entities.
     """
     timer = BasicTimer(f"Extracting Wikidata entities information")
     # Iterate through the Wikipedia popularity dump without decompressing it,
@@ -102,53 +164,46 @@ def extract_entity_information(popularity_dump, wikidata_dump, output_file):
 
     # Iterate through the Wikidata dump without decompressing it
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    writer = gzip.open(output_file, "wb")
 
-    with bz2.open(wikidata_dump, "rt") as bz_file:
-        lines_written = 0
+    def candidate_lines(bz_file):
         # Each line corresponds to a dictionary about a Wikidata entity
         for line in tqdm.tqdm(bz_file, desc="Processing Wikidata", smoothing=0):
-            # The first and last lines of this file are list delimiters, skip these.
-            # We also add a hack that checks if the entity has an English Wikipedia
-            # page. If not, we skip the line (and thus the JSON loading which is slow)
-            # Removing this hack does not change the resulting file.
-            line = line.strip()
-            if line == "[" or line == "]" or '"enwiki"' not in line:
+            # We add a hack that checks if the entity has an English Wikipedia
+            # page. If not, we skip the line (and thus the decoding and JSON loading
+            # which is slow). This also skips the first and last lines of this file,
+            # which are list delimiters. Removing this hack does not change the
+            # resulting file.
+            if b'"enwiki"' not in line:
                 continue
+            # Remove the trailing comma (absent on the last entity), then decode
+            yield line.rstrip().rstrip(b",")
 
-            # Remove last character (comma), then decode
-            line = json.loads(line[:-1])
-
-            # For each line, extract out relevant Wikidata information
-            label = extract_label(line)
-            aliases = extract_aliases(line)
-            entity_types = extract_entity_types(line)
-            wikipedia_page = extract_wikipedia_page(line)
-            popularity = wiki_popularity.get(wikipedia_page)
-
-            # Skip if no entity type, label, or popularity value
-            if label is None or popularity is None or entity_types == []:
-                continue
-
-            entity_dict = {
-                "label": label,
-                "aliases": aliases,
-                "entity_types": entity_types,
-                "wikipedia_page": wikipedia_page,
-                "popularity": popularity,
-            }
-
+    def write_entities(entities, writer):
+        for entity_bytes in entities:
             # Write extracted dictionary into a JSON format, one line at a time
-            if lines_written > 0:
-                writer.write(b",\n")
-            writer.write(
-                f"{json.dumps(line['id'])}: "
-                f"{json.dumps(entity_dict, ensure_ascii=False)}".encode()
-            )
-            lines_written += 1
-
-    writer.write(b"\n}")
-    writer.close()
+            if entity_bytes is not None:
+                writer.write(entity_bytes)
+
+    # Leave the CPUs not taken by the workers to the decompressor threads
+    decompress_threads = max(1, (os.cpu_count() or 1) - num_workers)
+    with open_bz2(wikidata_dump, decompress_threads) as bz_file, gzip.open(
+        output_file, "wb"
+    ) as writer:
+        if num_workers > 1:
+            with multiprocessing.Pool(
+                num_workers,
+                initializer=_init_entity_worker,
+                initargs=(wiki_popularity,),
+            ) as pool:
+                # `imap` keeps the dump order, so the output is the same on every run
+                entities = pool.imap(
+                    process_entity_line, candidate_lines(bz_file), chunksize=1000
+                )
+                write_entities(entities, writer)
+        else:
+            _init_entity_worker(wiki_popularity)
+            write_entities(map(process_entity_line, candidate_lines(bz_file)), writer)
+
     timer.finish()
 
 
@@ -157,8 +212,8 @@ def main():
     For each Wikidata entity in the Wikidata dump, we extract out it's entity
     type, associated Wikipedia page (used for popularity), all aliases
     for the entity, and popularity of the entity's Wikipedia page, then write
-    this information into a compressed JSON file. We write each dictionary of entity
-    information in it's own line for easy readability.
+    this information into a compressed JSON lines file. We write each dictionary of entity
+    information in it's own line, so the file can be streamed.
     """
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -177,7 +232,15 @@ def main():
         "-o",
         "--output_file",
         default="wikidata/entity_info.json.gz",
-        help="Output compressed JSON file for writing Wikidata entity information.",
+        help="Output compressed JSON lines file for writing Wikidata entity information.",
+    )
+    parser.add_argument(
+        "-n",
+        "--num_workers",
+        type=int,
+        default=max(1, (os.cpu_count() or 1) // 2),
+        help="Number of processes used to decode and extract Wikidata entities. The "
+        "remaining CPUs decompress the dump, if indexed_bzip2 is installed.",
     )
     args = parser.parse_args()
 
@@ -185,6 +248,7 @@ def main():
         popularity_dump=args.popularity_dump,
         wikidata_dump=args.wikidata_dump,
         output_file=args.output_file,
+        num_workers=args.num_workers,
     )
 
 
@@ -3,24 +3,37 @@ Given the substitution function of your choice, will derive a new dataset out of
 one you specify, applying the appropriate substitution rules.
 """
 import argparse
-import copy
-import gzip
-import inspect
-import json
 import os
-import typing
 
 from src.classes.qadataset import QADataset
 from src.substitution_fns import *
-from src.utils import argparse_str2bool
+from src.utils import argparse_str2bool, json_dumps_line
 
-""" NB: Feel free to add custom functions here. """
+""" NB: Feel free to add custom functions here, along with their arguments in SUB_FN_KWARGS. """
 SUBSTITUTION_FNS = {
     "alias-substitution": alias_substitution_fn,
     "popularity-substitution": popularity_substitution_fn,
     "corpus-substitution": corpus_substitution_fn,
     "type-swap-substitution": type_swap_substitution_fn,
 }
+""" NB: The arguments from args passed on to each function, beyond the dataset and wikidata path. """
+SUB_FN_KWARGS = {
+    "alias-substitution": ("replace_every", "max_aliases", "category", "num_workers"),
+    "popularity-substitution": (
+        "replace_every",
+        "num_bins",
+        "max_ents_per_pop",
+        "category",
+        "num_workers",
+    ),
+    "corpus-substitution": ("replace_every", "num_samples", "category", "num_workers"),
+    "type-swap-substitution": (
+        "replace_every",
+        "num_samples",
+        "category",
+        "num_workers",
+    ),
+}
 
 
 def generate_substitutions(args):
@@ -31,22 +44,18 @@ def generate_substitutions(args):
     preprocessed_dataset = QADataset.load(dset_name)
 
     sub_fn = SUBSTITUTION_FNS[args.substitution]
-    # Only pass in the arguments from args that are identically named in the function signature
-    params = inspect.signature(sub_fn).parameters.values()
     sub_exs = sub_fn(
         preprocessed_dataset,
         args.wikidata,
-        **{p.name: vars(args)[p.name] for p in params if p.name in vars(args)},
+        **{k: getattr(args, k) for k in SUB_FN_KWARGS[args.substitution]},
     )
 
-    # Write final substitution set to args.outpath
+    # Stream the substitution set to args.outpath as examples are generated
     os.makedirs(os.path.dirname(args.outpath), exist_ok=True)
-    with open(args.outpath, "w") as outf:
-        json.dump({"dataset": f"{dset_name}-{args.substitution}"}, outf)
-        outf.write("\n")
+    with open(args.outpath, "wb", buffering=1 << 20) as outf:
+        outf.write(json_dumps_line({"dataset": f"{dset_name}-{args.substitution}"}))
         for ex in sub_exs:
-            json.dump(ex.json_dump(save_full=args.save_full), outf)
-            outf.write("\n")
+            outf.write(json_dumps_line(ex.json_dump(save_full=args.save_full)))
 
 
 if __name__ == "__main__":
@@ -94,6 +103,13 @@ if __name__ == "__main__":
         default=False,
         help="Whether to replace every original answer alias in the context, or just the primary one.",
     )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=1,
+        help="Number of processes used to derive substitute examples. Only used where "
+        "the multiprocessing start method is 'fork' (e.g. Linux before Python 3.14).",
+    )
 
     # Alias substitution-specific arguments
     alias_sub_parser = subparsers.add_parser("alias-substitution")
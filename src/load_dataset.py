@@ -3,11 +3,6 @@ Loads and preprocesses a dataset of your choice, saving it in a normalized forma
 ready to apply downstream substitution functions.
 """
 import argparse
-import gzip
-import json
-import typing
-
-import wget
 
 from src.classes.qadataset import *
 from src.utils import argparse_str2bool
@@ -29,7 +24,14 @@ DATASETS = {
 def load_and_preprocess_dataset(args):
     dataset_class, url_or_path = DATASETS[args.dataset]
     dataset = dataset_class.new(args.dataset, url_or_path)
-    dataset.preprocess(args.wikidata, args.ner_model, args.debug)
+    dataset.preprocess(
+        args.wikidata,
+        args.ner_model,
+        args.debug,
+        batch_size=args.batch_size,
+        n_process=args.n_process,
+        use_gpu=args.use_gpu,
+    )
 
 
 if __name__ == "__main__":
@@ -61,5 +63,25 @@ if __name__ == "__main__":
         default=False,
         help="If set to True, only 100 examples are processed, to speed up debugging.",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=128,
+        help="Number of answers the NER model processes at a time.",
+    )
+    parser.add_argument(
+        "--n-process",
+        type=int,
+        default=1,
+        help="Number of processes to run the NER model in, or -1 for one per CPU. Ignored when running on GPU.",
+    )
+    parser.add_argument(
+        "--use-gpu",
+        type=argparse_str2bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="If set to True, the NER model runs on the GPU.",
+    )
     args = parser.parse_args()
     load_and_preprocess_dataset(args)
@@ -1,14 +1,15 @@
-import copy
-import gzip
-import json
+import functools
+import multiprocessing
 import random
 import typing
 from collections import Counter, defaultdict
 
+import numpy as np
+
 from src.classes.answer import Answer
 from src.classes.qadataset import QADataset
 from src.classes.qaexample import QAExample
-from src.utils import normalize_text
+from src.utils import default_start_method, iter_wikidata_info, normalize_texts
 
 
 ####################################################################################################
@@ -20,8 +21,9 @@ def alias_substitution_fn(
     replace_every: bool,
     max_aliases: int,
     category: str,
+    num_workers: int = 1,
 ):
-    """Derives a new dataset of modified examples, where the original answer has been replaced
+    """Yields a new dataset of modified examples, where the original answer has been replaced
     with one of it's own wikidata aliases.
 
     Args:
@@ -33,17 +35,20 @@ def alias_substitution_fn(
             will replace the original answer with one of it's aliases, up to min(max_aliases, the number of available aliases).
         category: This limits substitution generation to only use original examples with this answer type category. 
             `ALL` is an option.
+        num_workers: How many processes to derive modified examples with.
     """
 
     def sub_fn(ex: QAExample):
         """Derive all modified examples from one original example."""
-        # Determine which aliases are valid substitutions
+        # Determine which aliases are valid substitutions, in a deterministic order
         # Store these as Dict[alias_text --> GoldAnswer] so we can retrieve the info for each alias
-        gold_answer_texts = [ga.text for ga in ex.gold_answers]
-        alias_to_info = {
-            alias: ga for ga in ex.gold_answers if ga.aliases for alias in ga.aliases
-        }
-        valid_aliases = list(set(alias_to_info.keys()) - set(gold_answer_texts))
+        gold_answer_texts = {ga.text for ga in ex.gold_answers}
+        alias_to_info = {}
+        for ga in ex.gold_answers:
+            for alias in ga.aliases or ():
+                if alias not in gold_answer_texts:
+                    alias_to_info[alias] = ga
+        valid_aliases = list(alias_to_info)
         sub_exs = [
             # As the sub_answer is an alias we expect the metadata to be mostly the same as the original answer
             create_new_example(
@@ -64,23 +69,26 @@ def alias_substitution_fn(
         ]
         return sub_exs
 
-    new_exs, num_alias_dist = [], []
-    for ex in dset.examples:
-        ex_answer_type = ex.get_example_answer_type()
+    num_alias_dist = []
+    category_lower = category.lower()
+    selected_exs = (
+        (ex,)
+        for ex, ex_answer_type in zip(dset.examples, dset.answer_types)
         if (
-            category.lower() == "all"
+            category_lower == "all"
             or (
-                category.lower() == "nonnumeric"
+                category_lower == "nonnumeric"
                 and category not in [None, "DATE", "NUMERIC"]
             )
-            or category.lower() == ex_answer_type.lower()
-        ):
-            alias_exs = sub_fn(ex)
-            # If not 0 then we select a subset of aliased substitution examples
-            if max_aliases:
-                alias_exs = alias_exs[:max_aliases]
-            new_exs.extend(alias_exs)
-            num_alias_dist.append(len(alias_exs))
+            or category_lower == ex_answer_type.lower()
+        )
+    )
+    for alias_exs in _map_examples(sub_fn, selected_exs, num_workers):
+        # If not 0 then we select a subset of aliased substitution examples
+        if max_aliases:
+            alias_exs = alias_exs[:max_aliases]
+        yield from alias_exs
+        num_alias_dist.append(len(alias_exs))
 
     print(
         f"Num New Examples Generated per Original Example (using max-aliases={max_aliases}, category={category})): {Counter(num_alias_dist)}"
@@ -89,7 +97,6 @@ def alias_substitution_fn(
         f"NB: The quantity of zeros reflects how many examples do not have wikidata IDs to draw aliases from."
     )
     print(f"Finished Alias Substitution.")
-    return new_exs
 
 
 def corpus_substitution_fn(
@@ -98,8 +105,9 @@ def corpus_substitution_fn(
     replace_every: bool,
     num_samples: int,
     category: str,
+    num_workers: int = 1,
 ):
-    """Derives a new dataset of modified examples, where the original answer has been replaced
+    """Yields a new dataset of modified examples, where the original answer has been replaced
     by another answer of the same `type` drawn randomly from the corpus of answers in the original dataset.
     This substitution function maintains the same distribution of answers as the original dataset.
 
@@ -111,45 +119,54 @@ def corpus_substitution_fn(
         num_samples: How many new (modified) examples to create from one original example.
         category: This limits substitution generation to only use original examples with this answer type category. 
             `ALL` is an option.
+        num_workers: How many processes to derive modified examples with.
     """
     # generate a corpus of substitute answers, keyed by answer type
-    answer_corpus_by_groups = group_answers_by_answer_type(dset)
+    answer_corpus_by_groups, group_norm_texts = group_answers_by_answer_type(dset)
+    rng = random.Random()
 
-    def sub_fn(ex: QAExample):
+    def sub_fn(ex: QAExample, ex_ans_typ: str, norm_gold_answers: typing.Set[str]):
         """Derive all modified examples from one original example."""
-        new_exs = []
-        ex_ans_typ = ex.get_example_answer_type()
-        if ex_ans_typ is not None:
-            for idx in range(num_samples):
-                sub_answer = select_random_non_identical_answer(
-                    ex, answer_corpus_by_groups[ex_ans_typ]
-                )
-                new_ex = create_new_example(
-                    ex=ex,
-                    new_id=f"corpus-sub-{idx}",
-                    answer_text=sub_answer.text,
-                    ner_label=sub_answer.ner_label,
-                    kb_id=sub_answer.kb_id,
-                    wikidata_label=sub_answer.wikidata_label,
-                    aliases=sub_answer.aliases,
-                    wikidata_types=sub_answer.wikidata_types,
-                    wikipedia_page=sub_answer.wikipedia_page,
-                    popularity=sub_answer.popularity,
-                    answer_type=sub_answer.answer_type,
-                    replace_every_original_answer=replace_every,
-                )
-                new_exs.append(new_ex)
-        return new_exs
+        sub_answers = select_random_non_identical_answers(
+            norm_gold_answers,
+            answer_corpus_by_groups[ex_ans_typ],
+            group_norm_texts[ex_ans_typ],
+            num_samples,
+            rng=rng,
+        )
+        return [
+            create_new_example(
+                ex=ex,
+                new_id=f"corpus-sub-{idx}",
+                answer_text=sub_answer.text,
+                ner_label=sub_answer.ner_label,
+                kb_id=sub_answer.kb_id,
+                wikidata_label=sub_answer.wikidata_label,
+                aliases=sub_answer.aliases,
+                wikidata_types=sub_answer.wikidata_types,
+                wikipedia_page=sub_answer.wikipedia_page,
+                popularity=sub_answer.popularity,
+                answer_type=sub_answer.answer_type,
+                replace_every_original_answer=replace_every,
+            )
+            for idx, sub_answer in enumerate(sub_answers)
+        ]
 
-    new_exs = []
-    for ex in dset.examples:
-        ex_answer_type = ex.get_example_answer_type()
-        if ex_answer_type is not None:
-            if category.lower() == "all" or category.lower() == ex_answer_type.lower():
-                exs = sub_fn(ex)
-                new_exs.extend(exs)
+    group_counter = Counter()
+    category_lower = category.lower()
+    selected_exs = (
+        (ex, ex_answer_type, norm_gold_answers)
+        for ex, ex_answer_type, norm_gold_answers in zip(
+            dset.examples, dset.answer_types, dset.norm_gold_texts
+        )
+        if ex_answer_type is not None
+        and (category_lower == "all" or category_lower == ex_answer_type.lower())
+    )
+    for exs in _map_examples(sub_fn, selected_exs, num_workers, rng=rng):
+        for new_ex in exs:
+            group_counter[new_ex.get_example_answer_type()] += 1
+            yield new_ex
 
-    group_counter = Counter([ex.get_example_answer_type() for ex in new_exs])
     print(
         f"Num New Examples Generated by Answer Type Group (using num-samples={num_samples}, category={category}): {group_counter}"
     )
@@ -157,7 +174,6 @@ def corpus_substitution_fn(
         f"NB: Not all original examples can be substituted, if their answer type is not discernable, or one of the 5 high-confidence identified by this NER model."
     )
     print(f"Finished Corpus Substitution.")
-    return new_exs
 
 
 def popularity_substitution_fn(
@@ -167,8 +183,9 @@ def popularity_substitution_fn(
     num_bins: int,
     max_ents_per_pop: int,
     category: str,
+    num_workers: int = 1,
 ):
-    """Derives a new dataset of modified examples, where the original answer has been replaced
+    """Yields a new dataset of modified examples, where the original answer has been replaced
     by a Wikidata entity of the same type, but with varying popularity. This
     substitution first splits all Wikidata entities into bins of equal sizes
     where each bin contains entities with similar popularities. For an original
@@ -190,14 +207,20 @@ def popularity_substitution_fn(
         category: This limits substitution generation to only use original examples with this 
             answer type category. `ALL` is an option. `PERSON` is the default for popularity
             substitution as it yields the most reliable values.
+        num_workers: ``int`` How many processes to derive modified examples with.
     """
+    rng = random.Random()
 
-    def sub_fn(ex: QAExample, wikidata_popularity_bins: typing.List[typing.Dict]):
+    def sub_fn(
+        ex: QAExample,
+        wikidata_popularity_bins: typing.List[typing.Dict],
+        bin_keys: typing.List[typing.Tuple[str]],
+    ):
         """Derive all modified examples from one original example."""
         new_exs = []
 
         for bin_id in range(len(wikidata_popularity_bins)):
-            sub_qid = random.choice(list(wikidata_popularity_bins[bin_id].keys()))
+            sub_qid = rng.choice(bin_keys[bin_id])
             sub_qid_info = wikidata_popularity_bins[bin_id][sub_qid]
 
             new_ex = create_new_example(
@@ -222,17 +245,26 @@ def popularity_substitution_fn(
         max_ents_per_pop=max_ents_per_pop,
         num_bins=num_bins,
     )
+    # Collect each bin's QIDs once, rather than on every draw
+    bin_keys = [tuple(b) for b in wikidata_popularity_bins]
+
+    num_new_exs = 0
+    category_lower = category.lower()
+    selected_exs = (
+        (ex,)
+        for ex, ex_answer_type in zip(dset.examples, dset.answer_types)
+        if ex_answer_type is not None
+        and (category_lower == "all" or category_lower == ex_answer_type.lower())
+    )
+    # Bind the bins to sub_fn, rather than passing them along with every example
+    bound_sub_fn = functools.partial(
+        sub_fn, wikidata_popularity_bins=wikidata_popularity_bins, bin_keys=bin_keys
+    )
+    for exs in _map_examples(bound_sub_fn, selected_exs, num_workers, rng=rng):
+        num_new_exs += len(exs)
+        yield from exs
 
-    new_exs = []
-    for ex in dset.examples:
-        ex_answer_type = ex.get_example_answer_type()
-        if ex_answer_type is not None:
-            if category.lower() == "all" or category.lower() == ex_answer_type.lower():
-                exs = sub_fn(ex, wikidata_popularity_bins)
-                new_exs.extend(exs)
-
-    print(f"Finished Popularity Substitution, yielding {len(new_exs)} new examples.")
-    return new_exs
+    print(f"Finished Popularity Substitution, yielding {num_new_exs} new examples.")
 
 
 def type_swap_substitution_fn(
@@ -241,8 +273,9 @@ def type_swap_substitution_fn(
     replace_every: bool,
     num_samples: int,
     category: str,
+    num_workers: int = 1,
 ):
-    """Derives a new dataset of modified examples, where the original answer has been replaced
+    """Yields a new dataset of modified examples, where the original answer has been replaced
     by another answer of a different `type` drawn randomly from the corpus of answers in the original dataset.
     This substitution function is the same as corpus_substitution_fn except the answer types are different
     rather than the same.
@@ -255,20 +288,31 @@ def type_swap_substitution_fn(
         num_samples: How many new (modified) examples to create from one original example.
         category: This limits substitution generation to only use original examples with this answer type category. 
             `ALL` is an option.
+        num_workers: How many processes to derive modified examples with.
     """
     # generate a corpus of substitute answers, keyed by answer type
-    answer_corpus_by_groups = group_answers_by_answer_type(dset)
+    answer_corpus_by_groups, group_norm_texts = group_answers_by_answer_type(dset)
+    rng = random.Random()
     group_types = list(answer_corpus_by_groups.keys())
-
-    def sub_fn(ex: QAExample, target_group: str):
-        """Derive all modified examples from one original example."""
+    # The answer types each answer type is swapped for, in the same order for all examples
+    target_groups_by_type = {
+        group: [target for target in group_types if target != group]
+        for group in group_types
+    }
+
+    def sub_fn(ex: QAExample, ex_ans_typ: str, norm_gold_answers: typing.Set[str]):
+        """Derive all modified examples from one original example, for every answer type
+        other than its own."""
         new_exs = []
-        ex_ans_typ = ex.get_example_answer_type()
-        if ex_ans_typ is not None:
-            for idx in range(num_samples):
-                sub_answer = select_random_non_identical_answer(
-                    ex, answer_corpus_by_groups[target_group]
-                )
+        for target_group in target_groups_by_type[ex_ans_typ]:
+            sub_answers = select_random_non_identical_answers(
+                norm_gold_answers,
+                answer_corpus_by_groups[target_group],
+                group_norm_texts[target_group],
+                num_samples,
+                rng=rng,
+            )
+            for idx, sub_answer in enumerate(sub_answers):
                 new_ex = create_new_example(
                     ex=ex,
                     new_id=f"type-swap-sub-{idx}",
@@ -286,26 +330,26 @@ def type_swap_substitution_fn(
                 new_exs.append(new_ex)
         return new_exs
 
-    new_exs = []
-    for ex in dset.examples:
-        ex_answer_type = ex.get_example_answer_type()
-        if ex_answer_type is not None:
-            if category.lower() == "all" or category.lower() == ex_answer_type.lower():
-                for target_group in group_types:
-                    if target_group == ex.get_example_answer_type():
-                        continue
-                    exs = sub_fn(ex, target_group)
-                    new_exs.extend(exs)
-
-    group_counter = Counter(
-        [
-            (
-                ex.get_example_answer_type(),
-                ex.original_example.get_example_answer_type(),
-            )
-            for ex in new_exs
-        ]
+    group_counter = Counter()
+    category_lower = category.lower()
+    selected_exs = (
+        (ex, ex_answer_type, norm_gold_answers)
+        for ex, ex_answer_type, norm_gold_answers in zip(
+            dset.examples, dset.answer_types, dset.norm_gold_texts
+        )
+        if ex_answer_type is not None
+        and (category_lower == "all" or category_lower == ex_answer_type.lower())
     )
+    for exs in _map_examples(sub_fn, selected_exs, num_workers, rng=rng):
+        for new_ex in exs:
+            group_counter[
+                (
+                    new_ex.get_example_answer_type(),
+                    new_ex.original_example.get_example_answer_type(),
+                )
+            ] += 1
+            yield new_ex
+
     print(
         f"Num New Examples Generated by Answer Type Group (using num-samples={num_samples}, category={category})): {group_counter}"
     )
@@ -313,7 +357,6 @@ def type_swap_substitution_fn(
         f"NB: Not all original examples can be substituted, if their answer type is not discernable, or one of the 5 high-confidence identified by this NER model."
     )
     print(f"Finished Type Swap Substitution.")
-    return new_exs
 
 
 ####################################################################################################
@@ -335,8 +378,8 @@ def create_new_example(
     answer_type: str,
     replace_every_original_answer: bool,
 ):
-    """Creates a new example from the original example, given the specified new metadata. Copies the 
-    original example, initializes a new answer, and applies the answer substitution to the example.
+    """Creates a new example from the original example, given the specified new metadata. Initializes
+    a new answer, and derives a substitute example from the original with it.
     
     Args:
         ex: The original example
@@ -344,7 +387,6 @@ def create_new_example(
         replace_every_original_answer: If False, only replace the main gold answer that appears
             in the text, otherwise replace all valid gold answers that appear in the text.
     """
-    sub_ex = copy.deepcopy(ex)
     sub_answer = Answer(
         text=answer_text,
         spans=None,
@@ -357,34 +399,56 @@ def create_new_example(
         popularity=popularity,
         answer_type=answer_type,
     )
-    sub_ex.apply_substitution(
-        sub_answer,
-        ex,
-        new_id,
-        replace_every_original_answer=replace_every_original_answer,
+    return ex.substitute(
+        sub_answer, new_id, replace_every_original_answer=replace_every_original_answer
     )
-    return sub_ex
 
 
 def group_answers_by_answer_type(dset: QADataset):
-    """Reorganizes a QADataset into a mapping from answer type to member answers."""
+    """Reorganizes a QADataset into a mapping from answer type to a list of member answers,
+    deduplicated by normalized text. Also returns a mapping from answer type to the parallel
+    list of those answers' normalized texts."""
+    typed_answers = [
+        answer
+        for ex in dset.examples
+        for answer in ex.gold_answers
+        if answer.answer_type
+    ]
+    norm_texts = normalize_texts(answer.text for answer in typed_answers)
     group_to_answer_sets = defaultdict(dict)
-    for ex in dset.examples:
-        for answer in ex.gold_answers:
-            if answer.answer_type:
-                group_to_answer_sets[answer.answer_type][answer.text] = answer
-    return group_to_answer_sets
-
+    for answer, norm_text in zip(typed_answers, norm_texts):
+        group_to_answer_sets[answer.answer_type][norm_text] = answer
+    group_to_answers, group_to_norm_texts = {}, {}
+    for group, answer_set in group_to_answer_sets.items():
+        group_to_answers[group] = list(answer_set.values())
+        group_to_norm_texts[group] = list(answer_set.keys())
+    return group_to_answers, group_to_norm_texts
+
+
+def select_random_non_identical_answers(
+    norm_gold_answers: typing.Set[str],
+    answers: typing.List[Answer],
+    norm_texts: typing.List[str],
+    num_samples: int,
+    rng: typing.Optional[random.Random] = None,
+):
+    """Randomly samples up to `num_samples` distinct answers from `answers` that are
+    non-identical to the (normalized) gold answers of a QAExample. `norm_texts` holds the
+    normalized text of each answer, as returned by `group_answers_by_answer_type`. Draws
+    from `rng` if given, otherwise from the `random` module.
 
-def select_random_non_identical_answer(ex: QAExample, sample_set: typing.List[str]):
-    """Randomly samples an answer from `sample_set` that is non-identical to the gold answers
-    currently represented in the QAExample."""
-    norm_gold_answers = {normalize_text(ga.text): ga for ga in ex.gold_answers}
-    sample_keys = list(sample_set.keys())
-    sub_key = None
-    while not sub_key or normalize_text(sub_key) in norm_gold_answers:
-        sub_key = random.choice(sample_keys)
-    return sample_set[sub_key]
+    All samples are drawn at once, without replacement, as indices into `answers`. Fewer
+    than `num_samples` answers are returned only if `answers` runs out of non-identical ones.
+    """
+    # Each gold answer can reject at most one draw, so oversample by that many.
+    num_draws = min(len(answers), num_samples + len(norm_gold_answers))
+    sample = (rng or random).sample
+    sub_idxs = [
+        idx
+        for idx in sample(range(len(answers)), num_draws)
+        if norm_texts[idx] not in norm_gold_answers
+    ]
+    return [answers[idx] for idx in sub_idxs[:num_samples]]
 
 
 def bin_wikidata_entities_by_popularity(
@@ -405,28 +469,31 @@ def bin_wikidata_entities_by_popularity(
         entity_popularity_bins: ``List[Dict]`` Returns a list where each list
         corresponds to a bin. Within each list if a dictionary with entity information.
     """
-    with gzip.open(wikidata_info_path, "r") as reader:
-        wikidata_info = json.load(reader)
-
-    # Delete entities without the desired entity type
-    for kb_id in list(wikidata_info.keys()):
-        if "Q5" not in wikidata_info[kb_id]["entity_types"]:
-            del wikidata_info[kb_id]
-
+    # Stream the entities, only keeping those with the desired entity type.
     # If there are multiple entities with the same pop, we only keep the first
     # `max_ents_per_pop`. This ensures that when we group entities into
     # equally sized bins, that we don't have too much bleeding where
     # entities with the same popularity are in different bins
+    wikidata_info = {}
     num_ents_per_pop = defaultdict(int)
-    for kb_id in list(wikidata_info.keys()):
-        pop = wikidata_info[kb_id]["popularity"]
-        if num_ents_per_pop[pop] >= max_ents_per_pop:
-            del wikidata_info[kb_id]
+    for kb_id, info in iter_wikidata_info(wikidata_info_path):
+        if "Q5" not in info["entity_types"]:
+            continue
+        pop = info["popularity"]
+        if num_ents_per_pop[pop] < max_ents_per_pop:
+            wikidata_info[kb_id] = info
         num_ents_per_pop[pop] += 1
 
-    # Sort entity IDs (QID) by their popularity
-    # type(entities) = List[str]
-    kb_ids = sorted(wikidata_info, key=lambda x: wikidata_info[x]["popularity"])
+    # Sort entity IDs (QID) by their popularity. The sort is stable, so entities
+    # with the same popularity stay in the order they appear in `wikidata_info`.
+    # type(kb_ids) = np.ndarray[str]
+    kb_ids = np.array(list(wikidata_info), dtype=object)
+    popularities = np.fromiter(
+        (info["popularity"] for info in wikidata_info.values()),
+        dtype=np.int64,
+        count=len(wikidata_info),
+    )
+    kb_ids = kb_ids[np.argsort(popularities, kind="stable")]
 
     # Split list of entities into a list (of len `num_bins`) of list of entities
     # type(entity_popularity_bins) = List[Dict]
@@ -437,3 +504,55 @@ def bin_wikidata_entities_by_popularity(
     ]
 
     return entity_popularity_bins
+
+
+# The per-example function run by each worker process, set by `_init_substitution_worker`.
+_SUBSTITUTION_WORKER_FN = None
+
+
+def _init_substitution_worker(
+    fn: typing.Callable, rng: typing.Optional[random.Random] = None
+):
+    """Installs `fn` in a freshly forked worker and reseeds its random state, including
+    `rng` (the worker's copy of the generator `fn` draws from), so workers don't all draw
+    the same substitutes."""
+    global _SUBSTITUTION_WORKER_FN
+    _SUBSTITUTION_WORKER_FN = fn
+    random.seed()
+    if rng is not None:
+        rng.seed()
+
+
+def _apply_substitution_worker_fn(args: typing.Tuple):
+    return _SUBSTITUTION_WORKER_FN(*args)
+
+
+def _map_examples(
+    fn: typing.Callable,
+    arg_tuples: typing.Iterable[typing.Tuple],
+    num_workers: int,
+    rng: typing.Optional[random.Random] = None,
+):
+    """Yields `fn(*args)` for each tuple in `arg_tuples`, in order, spreading the calls over
+    `num_workers` forked processes. `rng` is the generator `fn` draws from, if any, which
+    each worker reseeds.
+
+    `fn` is usually a closure over a substitution function's corpus, which can't be pickled,
+    so workers are forked to inherit it and only the arguments are sent to them. Falls back
+    to running in-process when `num_workers` is 1 or the start method is not "fork" (e.g.
+    the "spawn" default on macOS, where forking is unsafe).
+    """
+    start_method = default_start_method()
+    if num_workers > 1 and start_method != "fork":
+        print(
+            f"Multiprocessing start method is {start_method!r}, not 'fork', so deriving "
+            f"substitutes in one process rather than num_workers={num_workers}"
+        )
+    if num_workers <= 1 or start_method != "fork":
+        for args in arg_tuples:
+            yield fn(*args)
+        return
+    with multiprocessing.get_context("fork").Pool(
+        num_workers, initializer=_init_substitution_worker, initargs=(fn, rng)
+    ) as pool:
+        yield from pool.imap(_apply_substitution_worker_fn, arg_tuples, chunksize=64)
@@ -1,3 +1,7 @@
+import functools
+import json
+import logging
+import multiprocessing
 import os
 import re
 import string
@@ -7,6 +11,84 @@ import typing
 import spacy
 from tqdm import tqdm
 
+# Optional speedups are imported here once, each with a fallback, and imported from here by
+# the rest of the package.
+
+# isal's igzip is a faster drop-in replacement for the stdlib gzip module.
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import indexed_bzip2
+except ImportError:
+    indexed_bzip2 = None
+
+try:
+    import polars
+except ImportError:
+    polars = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# orjson (de)serializes the datasets several times faster than the stdlib json module.
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+
+    def json_dumps_line(obj) -> bytes:
+        """Serializes `obj` to a line of compact UTF-8 JSON bytes, ending in a newline."""
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        """Serializes `obj` to compact UTF-8 JSON bytes, matching `orjson.dumps`."""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+    def json_dumps_line(obj) -> bytes:
+        """Serializes `obj` to a line of compact UTF-8 JSON bytes, ending in a newline."""
+        return json_dumps(obj) + b"\n"
+
+
+# Pipeline components whose output `run_ner_linking` never reads. The parser is kept, as the
+# entity linker needs the sentence boundaries it sets.
+UNUSED_NER_PIPES = ["tagger", "textcat", "lemmatizer", "attribute_ruler"]
+# Components only needed to link entities to Wikidata, skipped when just labelling them.
+ENTITY_LINKING_PIPES = ["entity_linker", "parser"]
+# Entity linker IDs that are Wikidata QIDs, rather than e.g. NIL or empty.
+_QID_RE = re.compile(r"Q[0-9]+")
+
+# Used by `normalize_text`, compiled once rather than on every call. A run of whitespace
+# and articles collapses to a single space in one scan.
+_ARTICLES_AND_SPACE_RE = re.compile(r"(?:\s|\b(?:a|an|the)\b)+", re.UNICODE)
+_PUNCT_TABLE = str.maketrans("", "", string.punctuation)
+# ASCII text is lowercased and stripped of punctuation by a single bytes.translate.
+_ASCII_LOWER_TABLE = bytes.maketrans(
+    string.ascii_uppercase.encode(), string.ascii_lowercase.encode()
+)
+_ASCII_PUNCT = string.punctuation.encode()
+# The same normalization as polars (Rust regex) patterns. They only match Python's for ASCII
+# text: Rust's \s omits \x1c-\x1f (added back here), and its \b treats more Unicode
+# characters (e.g. combining marks) as word characters.
+_POLARS_PUNCT_PATTERN = "[" + re.escape(string.punctuation) + "]"
+_POLARS_ARTICLES_AND_SPACE_PATTERN = r"(?:[\s\x1c-\x1f]|\b(?:a|an|the)\b)+"
+# Below this many texts, polars' per-batch overhead outweighs its faster string kernels.
+_POLARS_MIN_TEXTS = 1000
+
 
 def argparse_str2bool(v):
     """Infers whether an argparse input indicates True or False."""
@@ -20,95 +102,309 @@ def argparse_str2bool(v):
         raise argparse.ArgumentTypeError("Boolean value expected.")
 
 
-def run_ner_linking(texts: typing.List[str], ner_model_path: str):
+def default_start_method() -> str:
+    """Returns the multiprocessing start method that new processes will use, without
+    fixing it as `multiprocessing.get_start_method()` would (which makes any later
+    `multiprocessing.set_start_method()` call fail)."""
+    start_method = multiprocessing.get_start_method(allow_none=True)
+    # The platform default is listed first
+    return start_method or multiprocessing.get_all_start_methods()[0]
+
+
+@functools.lru_cache(maxsize=4)
+def _load_nlp(ner_model_path: str, use_gpu: bool = False, link_entities: bool = True):
+    """Loads the NER model at `ner_model_path`, without the components in `UNUSED_NER_PIPES`
+    (nor `ENTITY_LINKING_PIPES`, unless `link_entities`), onto the GPU if `use_gpu`. Models
+    are cached, so repeated NER runs (e.g. over several datasets) only load each once.
+    """
+    if use_gpu:
+        spacy.require_gpu()
+    disable = UNUSED_NER_PIPES
+    if not link_entities:
+        disable = disable + ENTITY_LINKING_PIPES
+    return spacy.load(ner_model_path, disable=disable)
+
+
+def _iter_ner_linking(
+    texts: typing.List[str],
+    ner_model_path: str,
+    batch_size: int = 128,
+    n_process: int = 1,
+    use_gpu: bool = False,
+    link_entities: bool = True,
+):
+    """Loads and runs the Named Entity Recognition + Entity Linking model on all `texts`,
+    yielding each distinct text with the list of its named entities, their labels and
+    Wikidata IDs if found.
+
+    Texts are streamed through the model in batches of `batch_size`, split across
+    `n_process` processes (-1 for one per CPU), and each distinct text is only processed
+    once. Keep `batch_size * n_process` well below the number of texts, or some processes
+    will sit idle. If `use_gpu`, the model runs on the GPU in a single process. If not
+    `link_entities`, the entity linker is skipped and every Wikidata ID is None.
+
+    The model is loaded in this process before `nlp.pipe` starts any workers. With the
+    "fork" start method (the Linux default before Python 3.14), workers share its memory
+    pages copy-on-write. Other start methods give each worker a private copy of the model.
+    """
+    if use_gpu and n_process != 1:
+        print(f"Running NER on GPU in one process, rather than n_process={n_process}")
+        n_process = 1
+    start_method = default_start_method()
+    if n_process != 1 and start_method != "fork":
+        print(
+            f"Multiprocessing start method is {start_method!r}, "
+            f"so each of the NER processes will load its own copy of the model."
+        )
+    nlp = _load_nlp(ner_model_path, use_gpu, link_entities)
+    print(f"Running NER model components: {nlp.pipe_names}")
+
+    # Bound once, as it is checked against every entity's kb_id
+    is_qid = _QID_RE.fullmatch if link_entities else lambda kb_id: False
+    unique_texts = list(dict.fromkeys(texts))
+    docs = nlp.pipe(unique_texts, batch_size=batch_size, n_process=n_process)
+    for text, doc in tqdm(
+        zip(unique_texts, docs),
+        total=len(unique_texts),
+        desc="Running Named Entity Linking",
+    ):
+        datum = [
+            {
+                "text": e.text,
+                "label": e.label_,
+                "id": e.kb_id_ if is_qid(e.kb_id_) else None,
+            }
+            for e in doc.ents
+        ]
+        yield text, datum
+
+
+def run_ner_linking(
+    texts: typing.List[str],
+    ner_model_path: str,
+    batch_size: int = 128,
+    n_process: int = 1,
+    use_gpu: bool = False,
+    link_entities: bool = True,
+):
     """Loads and runs the Named Entity Recognition + Entity Linking model on all `texts`, 
     saving their named entity labels and Wikidata IDs if found.
+
+    Returns a list of `(text, named entities)` pairs, one per distinct text, in the order
+    the texts first appear. Callers that need to look results up by text can index the
+    list themselves. See `_iter_ner_linking` for the batching arguments.
+    """
+    return list(
+        _iter_ner_linking(
+            texts, ner_model_path, batch_size, n_process, use_gpu, link_entities
+        )
+    )
+
+
+def run_ner_linking_to_file(
+    texts: typing.List[str],
+    ner_model_path: str,
+    out_path: str,
+    batch_size: int = 128,
+    n_process: int = 1,
+    use_gpu: bool = False,
+    link_entities: bool = True,
+):
+    """Like `run_ner_linking`, but streams each text and its named entities to `out_path`
+    as a JSON line of `{"text": ..., "ents": [...]}`, rather than holding them all in
+    memory. Read them back with `load_ner_jsonl`.
+    """
+    with open(out_path, "wb") as outf:
+        for text, datum in _iter_ner_linking(
+            texts, ner_model_path, batch_size, n_process, use_gpu, link_entities
+        ):
+            outf.write(json_dumps_line({"text": text, "ents": datum}))
+
+
+def load_ner_jsonl(ner_path: str):
+    """Yields `(text, named entities)` pairs from a file written by `run_ner_linking_to_file`."""
+    with open(ner_path, "rb") as inf:
+        for line in inf:
+            obj = json_loads(line)
+            yield obj["text"], obj["ents"]
+
+
+def save_ner_arrow(ner_results: typing.List[typing.Tuple[str, list]], out_path: str):
+    """Saves `(text, named entities)` pairs, as returned by `run_ner_linking`, to an Arrow
+    IPC file at `out_path`. The entities are stored columnar, with one struct of `text`,
+    `label` and `id` per entity, so the file can be memory-mapped by `load_ner_arrow`
+    rather than rebuilt as Python dicts. Requires `pyarrow`.
+    """
+    if pyarrow is None:
+        raise ImportError("Saving NER results to Arrow requires `pyarrow`.")
+    ent_type = pyarrow.struct(
+        [
+            ("text", pyarrow.string()),
+            ("label", pyarrow.string()),
+            ("id", pyarrow.string()),
+        ]
+    )
+    table = pyarrow.table(
+        {
+            "text": pyarrow.array(
+                [text for text, _ in ner_results], type=pyarrow.string()
+            ),
+            "ents": pyarrow.array(
+                [ents for _, ents in ner_results], type=pyarrow.list_(ent_type)
+            ),
+        }
+    )
+    with pyarrow.OSFile(out_path, "wb") as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def load_ner_arrow(ner_path: str):
+    """Memory-maps NER results saved by `save_ner_arrow`, returning a `pyarrow.Table` with
+    a `text` column and an `ents` column of entity structs. Requires `pyarrow`.
     """
-    nlp = spacy.load(ner_model_path)
-
-    text_to_info = {}
-    for text in tqdm(texts, desc="Running Named Entity Linking"):
-        doc = nlp(text)
-        datum = []
-        for e in doc.ents:
-            kb_id = (
-                e.kb_id_ if "Q" == e.kb_id_[0] and e.kb_id_[1:].isnumeric() else None
-            )
-            datum.append(
-                {"text": e.text, "label": e.label_, "id": kb_id,}
-            )
-        text_to_info[text] = datum
-    return text_to_info
+    if pyarrow is None:
+        raise ImportError("Loading NER results from Arrow requires `pyarrow`.")
+    return pyarrow.ipc.open_file(pyarrow.memory_map(ner_path, "r")).read_all()
 
 
+def iter_wikidata_info(wikidata_info_path: str):
+    """Yields `(kb_id, entity_info)` pairs from the Wikidata entity info file generated
+    in Stage 2, so that callers only hold the entities they keep in memory.
+
+    Reads both the JSON lines format written by extract_wikidata_info.py (streamed line
+    by line), and the single JSON object of earlier versions, such as the published
+    entity_info.json.gz (streamed with `ijson` if installed).
+    """
+    with gzip.open(wikidata_info_path, "r") as inf:
+        try:
+            first_entity = json_loads(inf.readline())
+        except ValueError:
+            first_entity = None
+
+        if isinstance(first_entity, dict):
+            yield from first_entity.items()
+            for line in inf:
+                if line.strip():
+                    yield from json_loads(line).items()
+        else:
+            inf.seek(0)
+            if ijson is not None:
+                yield from ijson.kvitems(inf, "")
+            else:
+                yield from json.load(inf).items()
+
+
+@functools.lru_cache(maxsize=65536)
 def normalize_text(s):
-    """Lower text and remove punctuation, articles and extra whitespace."""
+    """Lower text and remove punctuation, articles and extra whitespace.
 
-    def remove_articles(text):
-        regex = re.compile(r"\b(a|an|the)\b", re.UNICODE)
-        return re.sub(regex, " ", text)
+    Results are cached, as the same answers are normalized again and again.
+    """
+    if s.isascii():
+        s = s.encode().translate(_ASCII_LOWER_TABLE, _ASCII_PUNCT).decode()
+    else:
+        s = s.lower().translate(_PUNCT_TABLE)
+    return _ARTICLES_AND_SPACE_RE.sub(" ", s).strip()
 
-    def white_space_fix(text):
-        return " ".join(text.split())
 
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return "".join(ch for ch in text if ch not in exclude)
+def normalize_texts(texts: typing.Iterable[str]) -> typing.List[str]:
+    """Applies `normalize_text` to each of `texts`, returning a list in the same order.
 
-    def lower(text):
-        return text.lower()
+    Large batches are normalized with polars' vectorized string expressions, if installed.
+    Non-ASCII texts, where its regex engine differs, still go through `normalize_text`.
+    """
+    if polars is None:
+        return list(map(normalize_text, texts))
+    texts = list(texts)
+    if len(texts) < _POLARS_MIN_TEXTS:
+        return list(map(normalize_text, texts))
 
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+    normalized = (
+        polars.Series(texts, dtype=polars.String)
+        .str.to_lowercase()
+        .str.replace_all(_POLARS_PUNCT_PATTERN, "")
+        .str.replace_all(_POLARS_ARTICLES_AND_SPACE_PATTERN, " ")
+        .str.strip_chars(" ")
+        .to_list()
+    )
+    return [
+        norm_text if text.isascii() else normalize_text(text)
+        for text, norm_text in zip(texts, normalized)
+    ]
 
 
 class BasicTimer(object):
-    """A basic timer that computes elapsed time of linear intervals."""
+    """A basic timer that computes elapsed time of linear intervals.
+
+    Reports are printed, unless a `logger` is given. Then intervals are only logged at
+    DEBUG level, and summarized at INFO level when the timer finishes.
+    """
 
-    def __init__(self, name: str) -> None:
+    def __init__(self, name: str, logger: logging.Logger = None) -> None:
         self._name = name
+        self._logger = logger
         self._running = True
         self._total = 0.0
-        self._start = round(time.time(), 2)
-        self._interval_time = round(time.time(), 2)
-        print(f"Timer [{self._name}] starting now")
+        self._intervals = []
+        self._start = time.perf_counter()
+        self._interval_time = time.perf_counter()
+        self._report(f"Timer [{self._name}] starting now")
+
+    def _report(self, message: str, level: int = logging.INFO) -> None:
+        if self._logger is None:
+            print(message)
+        else:
+            self._logger.log(level, message)
 
     def reset(self) -> "BasicTimer":
         self._running = True
-        self._total = 0
-        self._start = round(time.time(), 2)
+        self._total = 0.0
+        self._intervals = []
+        self._start = time.perf_counter()
         return self
 
     def interval(self, intervalName: str):
-        intervalTime = self._to_hms(round(time.time() - self._interval_time, 2))
-        print(f"Timer [{self._name}] interval [{intervalName}]: {intervalTime}")
-        self._interval_time = round(time.time(), 2)
+        now = time.perf_counter()
+        self._intervals.append((intervalName, now - self._interval_time))
+        intervalTime = self._to_hms(now - self._interval_time)
+        self._report(
+            f"Timer [{self._name}] interval [{intervalName}]: {intervalTime}",
+            logging.DEBUG,
+        )
+        self._interval_time = now
         return intervalTime
 
     def stop(self) -> "BasicTimer":
         if self._running:
             self._running = False
-            self._total += round(time.time() - self._start, 2)
+            self._total += time.perf_counter() - self._start
         return self
 
     def resume(self) -> "BasicTimer":
         if not self._running:
             self._running = True
-            self._start = round(time.time(), 2)
+            self._start = time.perf_counter()
         return self
 
     def time(self) -> float:
         if self._running:
-            return round(self._total + time.time() - self._start, 2)
-        return self._total
+            return round(self._total + time.perf_counter() - self._start, 2)
+        return round(self._total, 2)
 
     def finish(self) -> None:
         if self._running:
             self._running = False
-            self._total += round(time.time() - self._start, 2)
-            elapsed = self._to_hms(self._total)
-        print(f"Timer [{self._name}] finished in {elapsed}")
+            self._total += time.perf_counter() - self._start
+        elapsed = self._to_hms(self._total)
+        if self._logger is not None:
+            for intervalName, seconds in self._intervals:
+                self._report(
+                    f"Timer [{self._name}] interval [{intervalName}]: {self._to_hms(seconds)}"
+                )
+        self._report(f"Timer [{self._name}] finished in {elapsed}")
 
     def _to_hms(self, seconds: float) -> str:
-        m, s = divmod(seconds, 60)
+        m, s = divmod(round(seconds, 2), 60)
         h, m = divmod(m, 60)
         return "%dh %02dm %02ds" % (h, m, s)